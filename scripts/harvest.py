@@ -6,13 +6,29 @@ Harvest: DNS 采集器 (US 环境运行)
 从 Google 权威 DNS 获取 mtalk.google.com 的 IPv4 和 IPv6 地址。
 """
 
+import asyncio
+import bisect
+import functools
+import socket
+import struct
+import time
 import dns.message
-import dns.query
+import dns.asyncbackend
+import dns.asyncquery
 import dns.edns
-import ipaddress
-from typing import Set
+import dns.entropy
+import dns.exception
+import dns.flags
+import dns.inet
+from typing import Dict, List, Set, Tuple
+from dns.asyncbackend import DatagramSocket
 from dns.rdatatype import RdataType
 
+try:
+    import uvloop  # 可选加速: 更快的事件循环
+except ImportError:
+    uvloop = None
+
 
 # DNS 服务器列表 (多源诱捕)
 DNS_SERVERS = [
@@ -31,6 +47,14 @@ DNS_SERVERS = [
     "8.8.8.8",         # Google Public DNS
 ]
 
+# 支持 TCP 管线化的服务器: 每台复用一条长连接发送全部查询 (其余走 UDP)
+TCP_PIPELINE_SERVERS = {
+    "216.239.32.10",
+    "216.239.34.10",
+    "216.239.36.10",
+    "216.239.38.10",
+}
+
 # 中国核心骨干网 CIDR 列表 (用于生成 ECS 子网) - 扩展版
 CHINA_BACKBONE_V4 = [
     # 教育网
@@ -101,10 +125,76 @@ CHINA_BACKBONE_V6 = [
     "2402:4e00::/22",
 ]
 
+# Google 自有网段 (AS15169 前端): 响应中不在这些网段内的地址视为污染/错误结果,
+# 直接丢弃, 避免浪费 sommelier 的测速预算
+GOOGLE_NETS_V4 = [
+    "64.233.160.0/19",
+    "66.102.0.0/20",
+    "66.249.64.0/19",
+    "72.14.192.0/18",
+    "74.125.0.0/16",
+    "108.177.0.0/17",
+    "142.250.0.0/15",
+    "172.217.0.0/16",
+    "172.253.0.0/16",
+    "173.194.0.0/16",
+    "192.178.0.0/15",
+    "209.85.128.0/17",
+    "216.58.192.0/19",
+    "216.239.32.0/19",
+]
+
+GOOGLE_NETS_V6 = [
+    "2001:4860::/32",
+    "2404:6800::/32",
+    "2607:f8b0::/32",
+    "2800:3f0::/32",
+    "2a00:1450::/32",
+    "2c0f:fb50::/32",
+]
+
 TARGET_DOMAIN = "mtalk.google.com"
 OUTPUT_V4 = "raw_ips_v4.txt"
 OUTPUT_V6 = "raw_ips_v6.txt"
 
+# 并发配置: 全局 UDP 在途查询上限 (过高会导致 UDP 缓冲区丢包)。
+# 每个 worker 复用一个 UDP socket 且同时只有一个查询在途;
+# A / AAAA 两轮采集并发进行, 各分得一半 worker
+MAX_INFLIGHT = 256
+CONCURRENT_PASSES = 2
+
+
+def prefix_mask(bits: int, prefix_len: int) -> int:
+    """前缀长度对应的整数掩码 (如 bits=32, prefix_len=8 -> 0xff000000)"""
+    return ((1 << bits) - 1) ^ ((1 << (bits - prefix_len)) - 1)
+
+
+def fast_parse(subnet: str) -> tuple[int, bytes, int]:
+    """
+    解析子网字符串为 (地址族, 网络地址字节, 前缀长度)
+
+    直接用 inet_pton + 整数掩码完成, 不创建 ipaddress 网络对象；
+    主机位会被清零, 与 ip_network(strict=False) 语义一致。
+
+    Args:
+        subnet: 子网字符串，如 "1.0.0.0/8" 或 "240e::/12"
+
+    Returns:
+        (AF_INET/AF_INET6, packed 网络地址, 前缀长度) 元组
+    """
+    address, _, prefix = subnet.partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+
+    bits = len(packed) * 8
+    prefix_len = int(prefix) if prefix else bits
+    if not 0 <= prefix_len <= bits:
+        raise ValueError(f"Invalid prefix length in {subnet!r}")
+
+    mask = prefix_mask(bits, prefix_len)
+    network = (int.from_bytes(packed, 'big') & mask).to_bytes(len(packed), 'big')
+    return (family, network, prefix_len)
+
 
 def parse_subnet(subnet: str) -> tuple[str, int]:
     """
@@ -116,8 +206,83 @@ def parse_subnet(subnet: str) -> tuple[str, int]:
     Returns:
         (地址, 前缀长度) 元组
     """
-    network = ipaddress.ip_network(subnet, strict=False)
-    return (str(network.network_address), network.prefixlen)
+    family, network, prefix_len = fast_parse(subnet)
+    return (socket.inet_ntop(family, network), prefix_len)
+
+
+def unique_subnets(subnets: List[str]) -> List[str]:
+    """
+    规范化并去重子网列表 (保持原有顺序)
+
+    写法不同但语义相同的 CIDR (如主机位非零) 也会被合并，
+    避免对同一子网重复发起查询。
+
+    Args:
+        subnets: 子网字符串列表
+
+    Returns:
+        去重后的规范化子网列表
+    """
+    return list(dict.fromkeys(
+        "%s/%d" % parse_subnet(subnet) for subnet in subnets
+    ))
+
+
+def build_cidr_table(subnets: List[str]) -> Dict[int, Tuple[List[int], List[int]]]:
+    """
+    将子网列表编译为按地址族分组的有序区间表
+
+    每个网段转为整数区间 [start, end] 并按 start 排序；CIDR 之间只会嵌套、
+    不会部分重叠, 线性扫描时把重叠区间并入前一区间 (终点取较大者),
+    得到互不相交的区间, 查询时二分即可。
+
+    Args:
+        subnets: 子网字符串列表
+
+    Returns:
+        {AF_INET: (starts, ends), AF_INET6: (starts, ends)}
+    """
+    ranges = {socket.AF_INET: [], socket.AF_INET6: []}
+    for subnet in subnets:
+        family, network, prefix_len = fast_parse(subnet)
+        bits = len(network) * 8
+        start = int.from_bytes(network, 'big')
+        host_mask = ((1 << bits) - 1) ^ prefix_mask(bits, prefix_len)
+        ranges[family].append((start, start | host_mask))
+
+    table = {}
+    for family, items in ranges.items():
+        starts, ends = [], []
+        for start, end in sorted(items):
+            if ends and start <= ends[-1]:
+                # 与前一区间重叠 (嵌套): 合并并保留更远的终点,
+                # 同起点的网段按 end 升序排列, 窄的在前, 不能直接丢弃后来的宽网段
+                ends[-1] = max(ends[-1], end)
+                continue
+            starts.append(start)
+            ends.append(end)
+        table[family] = (starts, ends)
+    return table
+
+
+def in_cidr_table(address: str, table: Dict[int, Tuple[List[int], List[int]]]) -> bool:
+    """判断地址是否落在表中任一网段内 (整数二分查找, 不构造 ipaddress 对象)"""
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        value = int.from_bytes(socket.inet_pton(family, address), 'big')
+    except OSError:
+        return False
+    starts, ends = table[family]
+    i = bisect.bisect_right(starts, value) - 1
+    return i >= 0 and value <= ends[i]
+
+
+# 响应地址白名单 (启动时编译一次)
+GOOGLE_NETS = build_cidr_table(GOOGLE_NETS_V4 + GOOGLE_NETS_V6)
+
+# 实际用于查询的 ECS 子网 (启动时去重一次)
+ECS_SUBNETS_V4 = unique_subnets(CHINA_BACKBONE_V4 + TAIWAN_BACKBONE_V4)
+ECS_SUBNETS_V6 = unique_subnets(CHINA_BACKBONE_V6)
 
 
 def create_ecs_option(subnet: str) -> dns.edns.ECSOption:
@@ -136,8 +301,55 @@ def create_ecs_option(subnet: str) -> dns.edns.ECSOption:
     return dns.edns.ECSOption(address, srclen=prefix_len, scopelen=0)
 
 
-def query_with_ecs(dns_server: str, qname: str, rdtype: RdataType,
-                   ecs_subnet: str, timeout: float = 10.0) -> Set[str]:
+@functools.lru_cache(maxsize=None)
+def build_query_wire(qname: str, rdtype: RdataType, ecs_subnet: str) -> bytes:
+    """
+    构造带 ECS 的查询报文线格式模板 (每个 (域名, 类型, 子网) 只构造并序列化一次)
+
+    Args:
+        qname: 查询域名
+        rdtype: 记录类型 (A 或 AAAA)
+        ecs_subnet: ECS 子网
+
+    Returns:
+        查询报文线格式 (只读, 事务 ID 由 render_query 写入)
+    """
+    msg = dns.message.make_query(qname, rdtype, want_dnssec=False)
+    msg.use_edns(ednsflags=0, options=[create_ecs_option(ecs_subnet)])
+    return msg.to_wire()
+
+
+def render_query(qname: str, rdtype: RdataType, ecs_subnet: str, txid: int) -> bytearray:
+    """
+    复制线格式模板并原地写入事务 ID (报文头前 2 字节)
+
+    Args:
+        qname: 查询域名
+        rdtype: 记录类型 (A 或 AAAA)
+        ecs_subnet: ECS 子网
+        txid: 16 位事务 ID
+
+    Returns:
+        可直接发送的查询报文
+    """
+    wire = bytearray(build_query_wire(qname, rdtype, ecs_subnet))
+    struct.pack_into('!H', wire, 0, txid)
+    return wire
+
+
+def is_reply_to(response: dns.message.Message, txid: int) -> bool:
+    """判断响应是否对应指定事务 ID 的查询"""
+    return response.id == txid and bool(response.flags & dns.flags.QR)
+
+
+def extract_addrs(response: dns.message.Message, rdtype: RdataType) -> Set[str]:
+    """从响应的 answer 段提取指定类型的地址 (跳过 CNAME 等其他类型的 rrset)"""
+    return {rr.address for rrset in response.answer if rrset.rdtype == rdtype for rr in rrset}
+
+
+async def query_with_ecs(dns_server: str, qname: str, rdtype: RdataType,
+                         ecs_subnet: str, sock: DatagramSocket,
+                         timeout: float = 10.0) -> Set[str]:
     """
     使用指定 DNS 服务器和 ECS 子网查询记录
 
@@ -146,45 +358,152 @@ def query_with_ecs(dns_server: str, qname: str, rdtype: RdataType,
         qname: 查询域名
         rdtype: 记录类型 (A 或 AAAA)
         ecs_subnet: ECS 子网 (如 "1.0.0.0/8" 或 "240e::/12")
+        sock: 复用的 UDP socket (由 worker 持有)
         timeout: 超时时间(秒)
 
     Returns:
         收集到的 IP 地址集合
     """
-    msg = dns.message.make_query(qname, rdtype, want_dnssec=False)
-
-    # 添加 ECS 选项
-    ecs_opt = create_ecs_option(ecs_subnet)
-    msg.use_edns(ednsflags=0, options=[ecs_opt])
+    # 只改写模板中的事务 ID, 不再逐次构造/序列化报文
+    txid = dns.entropy.random_16()
+    wire = render_query(qname, rdtype, ecs_subnet, txid)
+    destination = dns.inet.low_level_address_tuple((dns_server, 53))
+    expiration = time.time() + timeout
 
     try:
-        response = dns.query.udp(msg, dns_server, timeout=timeout, port=53)
-
-        addrs = set()
-        for rrset in response.answer:
-            if rdtype == RdataType.A and rrset.rdtype == RdataType.A:
-                for rr in rrset:
-                    addrs.add(str(rr))
-            elif rdtype == RdataType.AAAA and rrset.rdtype == RdataType.AAAA:
-                for rr in rrset:
-                    addrs.add(str(rr))
-
-        return addrs
-    except Exception as e:
+        await dns.asyncquery.send_udp(sock, wire, destination, expiration)
+
+        # socket 是复用的: 可能收到上一次超时查询的迟到响应,
+        # 按来源地址 + 16 位事务 ID 匹配, 丢弃不属于本次查询的报文
+        while True:
+            try:
+                response, _, _ = await dns.asyncquery.receive_udp(
+                    sock, destination, expiration, ignore_unexpected=True)
+            except dns.exception.Timeout:
+                raise
+            except dns.exception.DNSException:
+                # 无法解析的报文直接丢弃, 继续等待本次查询的响应
+                # (不依赖 receive_udp 的 ignore_errors, 该参数在 dnspython 2.6 才加入)
+                continue
+            if is_reply_to(response, txid):
+                return extract_addrs(response, rdtype)
+    except (dns.exception.DNSException, OSError) as e:
         print(f"[WARN] Query {dns_server} for {qname} with ECS {ecs_subnet} failed: {e}")
         return set()
 
 
-def query_all(dns_server: str, qname: str, rdtype: RdataType,
-              ecs_subnets: list, timeout: float = 10.0) -> Set[str]:
+async def query_worker(queue: asyncio.Queue, results: List[Set[str]],
+                       qname: str, rdtype: RdataType, timeout: float):
+    """查询 worker: 整个生命周期只持有一个 UDP socket (按地址族), 逐个消费任务"""
+    backend = dns.asyncbackend.get_default_backend()
+    socks = {}
+
+    try:
+        while True:
+            try:
+                index, (dns_server, ecs_subnet) = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+            af = dns.inet.af_for_address(dns_server)
+            if af not in socks:
+                socks[af] = await backend.make_socket(
+                    af, socket.SOCK_DGRAM, 0, (dns.inet.any_for_af(af), 0))
+
+            results[index] = await query_with_ecs(dns_server, qname, rdtype,
+                                                  ecs_subnet, socks[af], timeout)
+    finally:
+        for sock in socks.values():
+            await sock.close()
+
+
+async def query_pipelined(dns_server: str, jobs: List[Tuple[int, str]],
+                          results: List[Set[str]], qname: str, rdtype: RdataType,
+                          timeout: float = 10.0) -> List[Tuple[int, str]]:
     """
-    使用指定 DNS 服务器轮询所有 ECS 子网
+    通过一条 TCP 长连接管线化发送某台服务器的全部查询
+
+    所有查询连续写出, 响应按 16 位事务 ID 分发, 只付一次握手开销。
 
     Args:
         dns_server: DNS 服务器 IP
+        jobs: (结果下标, ECS 子网) 任务列表
+        results: 结果列表 (按下标写入)
+        qname: 查询域名
+        rdtype: 记录类型 (RdataType.A 或 RdataType.AAAA)
+        timeout: 整条管线的超时时间(秒)
+
+    Returns:
+        未拿到响应的任务列表 (交给 UDP 回退)
+    """
+    backend = dns.asyncbackend.get_default_backend()
+    af = dns.inet.af_for_address(dns_server)
+    expiration = time.time() + timeout
+
+    # 先为所有任务分配互不冲突的事务 ID, 管线中途断开时剩余任务可完整回退
+    pending = {}
+    for index, ecs_subnet in jobs:
+        txid = dns.entropy.random_16()
+        while txid in pending:
+            txid = dns.entropy.random_16()
+        pending[txid] = (index, ecs_subnet, render_query(qname, rdtype, ecs_subnet, txid))
+
+    try:
+        sock = await backend.make_socket(af, socket.SOCK_STREAM, 0, None,
+                                         (dns_server, 53), timeout)
+    except (dns.exception.DNSException, OSError, EOFError) as e:
+        print(f"[WARN] TCP connect to {dns_server} failed: {e}, falling back to UDP")
+        return jobs
+
+    try:
+        for _, _, wire in pending.values():
+            await dns.asyncquery.send_tcp(sock, wire, expiration)
+
+        while pending:
+            response, _ = await dns.asyncquery.receive_tcp(sock, expiration)
+            entry = pending.get(response.id)
+            if entry is None or not response.flags & dns.flags.QR:
+                continue
+            del pending[response.id]
+            results[entry[0]] = extract_addrs(response, rdtype)
+    except (dns.exception.DNSException, OSError, EOFError) as e:
+        print(f"[WARN] TCP pipeline to {dns_server} failed: {e}, "
+              f"{len(pending)} queries fall back to UDP")
+    finally:
+        await sock.close()
+
+    return [(index, ecs_subnet) for index, ecs_subnet, _ in pending.values()]
+
+
+async def query_udp(jobs: List[Tuple[int, Tuple[str, str]]], results: List[Set[str]],
+                    qname: str, rdtype: RdataType, timeout: float = 10.0):
+    """使用 UDP worker 池执行 (结果下标, (DNS 服务器, ECS 子网)) 任务"""
+    if not jobs:
+        return
+
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    num_workers = min(MAX_INFLIGHT // CONCURRENT_PASSES, len(jobs))
+    await asyncio.gather(*[
+        query_worker(queue, results, qname, rdtype, timeout)
+        for _ in range(num_workers)
+    ])
+
+
+async def query_all(jobs: List[Tuple[str, str]], qname: str, rdtype: RdataType,
+                    timeout: float = 10.0) -> Set[str]:
+    """
+    并发执行所有 (DNS 服务器, ECS 子网) 查询
+
+    TCP_PIPELINE_SERVERS 中的服务器各走一条管线化 TCP 长连接,
+    其余服务器 (以及 TCP 失败的任务) 走 UDP worker 池。
+
+    Args:
+        jobs: (DNS 服务器 IP, ECS 子网) 任务列表
         qname: 查询域名
         rdtype: 记录类型 (RdataType.A 或 RdataType.AAAA)
-        ecs_subnets: ECS 子网列表
         timeout: 超时时间
 
     Returns:
@@ -192,69 +511,91 @@ def query_all(dns_server: str, qname: str, rdtype: RdataType,
     """
     all_ips = set()
     rdtype_name = "A" if rdtype == RdataType.A else "AAAA"
-
-    for ecs_subnet in ecs_subnets:
-        ips = query_with_ecs(dns_server, qname, rdtype, ecs_subnet, timeout)
+    results = [set() for _ in jobs]
+
+    # 按传输方式拆分任务
+    tcp_jobs = {}
+    udp_jobs = []
+    for index, (dns_server, ecs_subnet) in enumerate(jobs):
+        if dns_server in TCP_PIPELINE_SERVERS:
+            tcp_jobs.setdefault(dns_server, []).append((index, ecs_subnet))
+        else:
+            udp_jobs.append((index, (dns_server, ecs_subnet)))
+
+    pipelines = [query_pipelined(dns_server, server_jobs, results, qname, rdtype, timeout)
+                 for dns_server, server_jobs in tcp_jobs.items()]
+    outcomes = await asyncio.gather(query_udp(udp_jobs, results, qname, rdtype, timeout),
+                                    *pipelines)
+
+    # TCP 管线未完成的任务回退到 UDP
+    fallback_jobs = [(index, (dns_server, ecs_subnet))
+                     for dns_server, leftover in zip(tcp_jobs, outcomes[1:])
+                     for index, ecs_subnet in leftover]
+    await query_udp(fallback_jobs, results, qname, rdtype, timeout)
+
+    for (dns_server, ecs_subnet), ips in zip(jobs, results):
         all_ips.update(ips)
         print(f"  [{rdtype_name}] {dns_server} + {ecs_subnet}: +{len(ips)}, total: {len(all_ips)}")
 
-    return all_ips
+    # 丢弃不属于 Google 网段的地址 (在去重后的集合上过滤, 每个地址只判断一次)
+    google_ips = {ip for ip in all_ips if in_cidr_table(ip, GOOGLE_NETS)}
+    if len(google_ips) < len(all_ips):
+        print(f"  [{rdtype_name}] Dropped {len(all_ips) - len(google_ips)} non-Google IPs")
+
+    return google_ips
 
 
-def harvest_v4() -> Set[str]:
+async def harvest_v4() -> Set[str]:
     """采集 IPv4 地址 (包含台湾省诱饵网段)"""
     print("\n=== Harvesting IPv4 ===")
-    all_ips = set()
-
-    # 合并中国骨干网 + 台湾省诱饵网段
-    all_subnets = CHINA_BACKBONE_V4 + TAIWAN_BACKBONE_V4
-    print(f"  Subnets: {len(CHINA_BACKBONE_V4)} CN + {len(TAIWAN_BACKBONE_V4)} TW = {len(all_subnets)} total")
 
-    for dns_server in DNS_SERVERS:
-        ips = query_all(dns_server, TARGET_DOMAIN, RdataType.A, all_subnets)
-        all_ips.update(ips)
+    # 中国骨干网 + 台湾省诱饵网段 (已去重)
+    print(f"  Subnets: {len(CHINA_BACKBONE_V4)} CN + {len(TAIWAN_BACKBONE_V4)} TW = {len(ECS_SUBNETS_V4)} unique")
 
-    return all_ips
+    # 所有 (服务器, 子网) 组合一次性交给 worker 池
+    jobs = [(dns_server, subnet) for dns_server in DNS_SERVERS for subnet in ECS_SUBNETS_V4]
+    return await query_all(jobs, TARGET_DOMAIN, RdataType.A)
 
 
-def harvest_v6() -> Set[str]:
+async def harvest_v6() -> Set[str]:
     """采集 IPv6 地址"""
     print("\n=== Harvesting IPv6 ===")
-    all_ips = set()
 
-    for dns_server in DNS_SERVERS:
-        ips = query_all(dns_server, TARGET_DOMAIN, RdataType.AAAA, CHINA_BACKBONE_V6)
-        all_ips.update(ips)
+    print(f"  Subnets: {len(CHINA_BACKBONE_V6)} CN = {len(ECS_SUBNETS_V6)} unique")
 
-    return all_ips
+    jobs = [(dns_server, subnet) for dns_server in DNS_SERVERS for subnet in ECS_SUBNETS_V6]
+    return await query_all(jobs, TARGET_DOMAIN, RdataType.AAAA)
 
 
 def save_ips(ips: Set[str], filepath: str):
-    """保存 IP 列表到文件"""
-    with open(filepath, 'w') as f:
-        for ip in sorted(ips):
-            f.write(f"{ip}\n")
-    print(f"Saved {len(ips)} IPs to {filepath}")
+    """保存 IP 列表到文件 (拼接后一次性写入)"""
+    payload = ("\n".join(sorted(ips)) + "\n").encode() if ips else b""
+    with open(filepath, 'wb') as f:
+        f.write(payload)
 
 
-def main():
+async def main():
     """主入口"""
     print("=" * 60)
     print("FCM Harvester - DNS 采集器")
     print("=" * 60)
     print(f"Target domain: {TARGET_DOMAIN}")
     print(f"DNS servers: {DNS_SERVERS}")
+    print(f"Max in-flight UDP queries: {MAX_INFLIGHT} (shared by A + AAAA), "
+          f"TCP pipelines: {len(TCP_PIPELINE_SERVERS) * CONCURRENT_PASSES}")
     print("-" * 60)
 
-    # 采集 IPv4
-    ipv4_ips = harvest_v4()
-    save_ips(ipv4_ips, OUTPUT_V4)
+    # IPv4 / IPv6 互不依赖, 两轮采集并发进行
+    ipv4_ips, ipv6_ips = await asyncio.gather(harvest_v4(), harvest_v6())
 
     print("-" * 60)
 
-    # 采集 IPv6
-    ipv6_ips = harvest_v6()
-    save_ips(ipv6_ips, OUTPUT_V6)
+    await asyncio.gather(
+        asyncio.to_thread(save_ips, ipv4_ips, OUTPUT_V4),
+        asyncio.to_thread(save_ips, ipv6_ips, OUTPUT_V6),
+    )
+    print(f"Saved {len(ipv4_ips)} IPs to {OUTPUT_V4}")
+    print(f"Saved {len(ipv6_ips)} IPs to {OUTPUT_V6}")
 
     print("=" * 60)
     print(f"Harvest complete: IPv4={len(ipv4_ips)}, IPv6={len(ipv6_ips)}")
@@ -262,4 +603,6 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(main())
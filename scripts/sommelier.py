@@ -2,21 +2,38 @@
 """
 Sommelier: IP 筛选器与负载均衡器 (CN 环境运行) - Project Mjolnir 2.0
 
-1. 高并发 TCP Connect 测速 (100 threads)
+1. 高并发 TCP Connect 测速 (asyncio 非阻塞 connect)
 2. C 段爆破 + 自适应选优
 3. 只保留前 9 名 (对应 9 个 FCM 域名)
 4. 生成三种 hosts 文件: IPv4 / Dual / IPv6
 """
 
+import asyncio
+import errno
+import heapq
+import itertools
+import json
+import math
+import os
 import socket
-import concurrent.futures
 import random
-from dataclasses import dataclass
-from typing import List, Dict, Tuple, Optional, Set
-from threading import Lock
+import struct
+from array import array
+from typing import Callable, Iterator, List, Dict, Tuple, Optional, Set
+from collections import deque
 import time
 from datetime import datetime, timezone
 
+try:
+    import uvloop  # 可选加速: 更快的事件循环
+except ImportError:
+    uvloop = None
+
+try:
+    import resource  # 仅 Unix 可用, 用于查询 fd 上限
+except ImportError:
+    resource = None
+
 # FCM 目标域名列表 - 十二金刚防御阵列
 FCM_DOMAINS = [
     "mtalk.google.com",
@@ -37,19 +54,133 @@ FCM_PORT = 5228  # FCM 专用心跳端口
 
 # 测速配置
 TCP_TIMEOUT = 1.5  # 1.5秒握不上就放弃
-MAX_WORKERS = 100  # 提升并发
+MAX_WORKERS = 512  # 同时在途的 connect 上限 (回调式发射, 每个在途 connect 只占一个 fd 和一个 writer 回调; main 中按 fd 上限收紧)
+
+# 自适应超时: 成功样本足够后, 把后续探测的超时收紧到 3 × p99 (不低于 0.3 秒)
+# 能连上的 IP 通常在百毫秒内完成握手, 不必为不可达 IP 等满 TCP_TIMEOUT
+ADAPTIVE_MIN_SAMPLES = 32   # 每收集这么多新成功样本重新估计一次
+ADAPTIVE_WINDOW = 256       # 只参考最近的成功样本
+ADAPTIVE_FACTOR = 3.0
+ADAPTIVE_FLOOR = 0.3        # 秒
+
+# 创建 socket 时直接带上非阻塞标志 (Linux), 省去每次 setblocking 的额外系统调用
+SOCK_NONBLOCK = getattr(socket, 'SOCK_NONBLOCK', 0)
+
+# SO_LINGER 选项值 (l_onoff=1, l_linger=0): 关闭时立即复位连接
+LINGER_ABORT = struct.pack('ii', 1, 0)
+
+# fd 上限中为标准流、日志等预留的余量
+FD_RESERVE = 64
+
+# 非阻塞 connect 进行中的唯一返回码。EAGAIN 对 TCP connect 是硬错误 (本地端口耗尽),
+# 若当作进行中, epoll 会报告可写且 SO_ERROR 为 0, 被误记为 ~0 ms 的成功。
+# 测速依赖 loop.add_writer, 只支持 POSIX 平台的 selector 事件循环 (不支持 Windows)
+CONNECT_PENDING = errno.EINPROGRESS
+
+# 日志中的地址族标签 (v4/v6 流水线并发运行, 输出交错时据此区分)
+FAMILY_LABELS = {socket.AF_INET: "IPv4", socket.AF_INET6: "IPv6"}
 
 # 选优配置
 MIN_IPS_PER_DOMAIN = 1  # 每个域名至少分配 N 个 IP
+# 爆破扫描时, 单个网段凑够这么多成功 IP (足以独自填满全部域名) 就停止该网段的剩余探测
+BLOCK_SUCCESS_QUOTA = len(FCM_DOMAINS) * MIN_IPS_PER_DOMAIN
+
+# 延迟数组中的特殊值 (均视为未连通, 但只有 -1 计入失败历史):
+#   -1 确定失败: 被拒绝 / 不可达, 或等满 TCP_TIMEOUT 仍未握手
+#   -2 未测: 网段提前终止而跳过, 或本机原因 (如 fd 耗尽) 未能发起
+#   -3 自适应超时截断: 只是慢于当前 p99 估计, 不代表 IP 失效
+PROBE_FAILED = -1.0
+PROBE_SKIPPED = -2.0
+PROBE_CUTOFF = -3.0
+
+# 跨运行缓存: 自托管 runner 的工作目录在两次运行之间保留, 缓存文件随之保留
+IP_CACHE_FILE = "ip_cache.json"
+DEAD_AFTER_FAILURES = 3         # 连续失败这么多次视为疑似失效
+RECHECK_PROBABILITY = 0.1       # 疑似失效的 IP 每次运行仍以此概率抽样复测
+CACHE_MAX_AGE = 7 * 24 * 3600   # 超过 7 天未测的记录直接丢弃 (秒)
+
+
+class SpeedResults:
+    """
+    测速结果 (列式存储 SoA)
+
+    ips 与 latencies 按下标一一对应; 延迟单位为毫秒, 失败记为 -1, 跳过记为 -2, 自适应超时截断记为 -3。
+    相比每个 IP 一个结果对象, 平行数组没有逐对象的内存与 GC 开销,
+    过滤和选优只需扫描一段连续的 double 数组。
+    成功数在测速时顺带统计, 下游无需为计数再扫一遍。
+    """
+
+    __slots__ = ('ips', 'latencies', 'success_count')
+
+    def __init__(self, ips: List[str], latencies: array, success_count: int):
+        self.ips = ips
+        self.latencies = latencies
+        self.success_count = success_count
+
+    @classmethod
+    def empty(cls) -> 'SpeedResults':
+        return cls([], array('d'), 0)
+
+    def __len__(self) -> int:
+        return len(self.ips)
+
+    def __add__(self, other: 'SpeedResults') -> 'SpeedResults':
+        """列式拼接两批结果"""
+        return SpeedResults(self.ips + other.ips, self.latencies + other.latencies,
+                            self.success_count + other.success_count)
+
+    def successful_indices(self) -> Iterator[int]:
+        """惰性产出成功 IP 的下标 (可直接喂给堆选择, 不落地中间列表)"""
+        return (i for i, latency in enumerate(self.latencies) if latency >= 0)
+
+    def successful_ips(self) -> List[str]:
+        """成功的 IP (保持原有顺序)"""
+        return [ip for ip, latency in zip(self.ips, self.latencies) if latency >= 0]
+
+
+def clamp_to_fd_limit(max_workers: int, share: int = 1) -> int:
+    """
+    把并发数限制在进程 fd 软上限之内, 避免 socket() 报 EMFILE
 
+    Args:
+        max_workers: 期望的在途 connect 数
+        share: 同时测速的批次数, fd 额度在它们之间平分
 
-@dataclass
-class SpeedResult:
-    """测速结果"""
-    ip: str
-    latency_ms: float
-    success: bool
-    error: Optional[str] = None
+    Returns:
+        实际可用的在途 connect 数
+    """
+    if resource is None:
+        return max_workers
+
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return max_workers
+    return max(1, min(max_workers, (soft - FD_RESERVE) // share))
+
+
+def create_probe_socket(family: int) -> socket.socket:
+    """创建一个用于测速的非阻塞 TCP socket"""
+    # 注意: 不要开启 TCP_FASTOPEN_CONNECT。它会推迟 SYN 到首次写入,
+    # connect() 立即返回, 测到的"握手延迟"将变成 0, 选优结果失真。
+    # TCP_NODELAY / TCP_QUICKACK 只影响数据段与延迟 ACK, 握手阶段的 SYN 与最终 ACK
+    # 内核本就立即发送; IP_BIND_ADDRESS_NO_PORT 只对先 bind() 再 connect() 的 socket
+    # 有意义, 这里不 bind, 端口本就在 connect 时才分配。三者对测速都无收益, 故不设置。
+    sock = socket.socket(family, socket.SOCK_STREAM | SOCK_NONBLOCK)
+    if not SOCK_NONBLOCK:
+        sock.setblocking(False)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # SO_LINGER {1, 0}: close() 直接发 RST, 握手成功的连接不进入 TIME_WAIT,
+    # 大批量扫描时不会耗尽本地端口。在 connect 计时开始之前设置, 不计入握手延迟
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_ABORT)
+    return sock
+
+
+def make_sockaddrs(ips: List[str], family: int, port: int) -> List[tuple]:
+    """按地址族一次性构造 connect 所需的 sockaddr 元组"""
+    # IPv4 使用 2 元组，IPv6 使用 4 元组
+    if family == socket.AF_INET6:
+        return [(ip, port, 0, 0) for ip in ips]
+    return [(ip, port) for ip in ips]
 
 
 class TCPSpeedometer:
@@ -58,38 +189,90 @@ class TCPSpeedometer:
     def __init__(self, port: int = FCM_PORT, timeout: float = TCP_TIMEOUT):
         self.port = port
         self.timeout = timeout
-
-    def measure(self, ip: str) -> SpeedResult:
+        # 当前生效的超时 (随成功样本自适应收紧, 不会超过 self.timeout)
+        self.current_timeout = timeout
+        self.samples = deque(maxlen=ADAPTIVE_WINDOW)
+        self.new_samples = 0
+        self.success_count = 0
+
+    def record_success(self, latency_ms: float):
+        """记录一次成功握手, 样本足够时按 p99 更新超时"""
+        self.success_count += 1
+        self.samples.append(latency_ms)
+        self.new_samples += 1
+        if self.new_samples < ADAPTIVE_MIN_SAMPLES:
+            return
+
+        self.new_samples = 0
+        ordered = sorted(self.samples)
+        p99 = ordered[math.ceil(len(ordered) * 0.99) - 1]
+        self.current_timeout = min(self.timeout,
+                                   max(ADAPTIVE_FLOOR, ADAPTIVE_FACTOR * p99 / 1000))
+
+    def probe(self, loop: asyncio.AbstractEventLoop, family: int, addr: tuple,
+              on_done: Callable[[float], None]) -> Optional[Callable[[], None]]:
         """
-        测量单个 IP 的 TCP 延迟
+        发起单个目标的非阻塞 TCP connect, 完成后回调 on_done(延迟毫秒, 失败为 -1)
+
+        connect 进入等待时返回取消函数: 调用后立即关闭 socket, 且不再回调 on_done;
+        同步完成 (立即成功/失败) 时返回 None。
+
+        直接注册可写事件 (epoll EPOLLOUT/EPOLLERR) 并读取 SO_ERROR 判定结果,
+        超时由事件循环定时器负责, 不为每个 IP 创建协程/Task。
+        地址族由调用方整批传入, sockaddr 已由 make_sockaddrs 预先算好, 热路径上没有分支判断。
         """
         sock = None
-        start_time = time.perf_counter()
-
         try:
-            # 根据 IP 版本选择地址族
-            if ':' in ip:  # IPv6
-                sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            else:  # IPv4
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            sock.settimeout(self.timeout)
-            # IPv4 使用 2 元组，IPv6 使用 4 元组
-            if ':' in ip:  # IPv6
-                sock.connect((ip, self.port, 0, 0))
-            else:  # IPv4
-                sock.connect((ip, self.port))
-
-            latency = (time.perf_counter() - start_time) * 1000
-            return SpeedResult(ip=ip, latency_ms=latency, success=True)
-
-        except socket.timeout:
-            return SpeedResult(ip=ip, latency_ms=-1, success=False, error="timeout")
-        except Exception as e:
-            return SpeedResult(ip=ip, latency_ms=-1, success=False, error=str(e))
-        finally:
+            sock = create_probe_socket(family)
+            start_time = time.perf_counter()
+            err = sock.connect_ex(addr)
+        except Exception:  # 非法地址 / fd 耗尽: 本机问题, 不归咎于目标 IP
             if sock:
                 sock.close()
+            loop.call_soon(on_done, PROBE_SKIPPED)
+            return
+
+        if err == 0:  # 本机地址可能立即连上
+            latency = (time.perf_counter() - start_time) * 1000
+            sock.close()
+            self.record_success(latency)
+            loop.call_soon(on_done, latency)
+            return
+        if err != CONNECT_PENDING:  # 立即失败 (如网络不可达)
+            sock.close()
+            loop.call_soon(on_done, PROBE_FAILED)
+            return
+
+        fd = sock.fileno()
+
+        def cancel():
+            loop.remove_writer(fd)
+            timer.cancel()
+            sock.close()
+
+        def complete(latency: float):
+            cancel()
+            on_done(latency)
+
+        def on_writable():
+            ready_time = time.perf_counter()
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                latency = (ready_time - start_time) * 1000
+                self.record_success(latency)
+                complete(latency)
+            else:
+                complete(PROBE_FAILED)
+
+        # 超时已被自适应收紧时, 到点只记为截断, 不当作确定失败
+        timeout = self.current_timeout
+        timed_out = PROBE_FAILED if timeout >= self.timeout else PROBE_CUTOFF
+        timer = loop.call_later(timeout, complete, timed_out)
+        loop.add_writer(fd, on_writable)
+        return cancel
+
+
+# 0-255 的十进制文本, 扩展 C 段时直接查表拼接, 免去逐个格式化整数
+OCTET_TEXT = tuple(str(i) for i in range(256))
 
 
 class CSegmentExpander:
@@ -102,18 +285,19 @@ class CSegmentExpander:
         """扩展 IPv4: 种子 IP 前后 10 个地址 (Window Size = 20)
         例如: 1.2.3.188 -> 1.2.3.178 到 1.2.3.198
         """
-        parts = ip.split('.')
-        if len(parts) != 4:
+        # 只切最后一段, 前缀原样复用, 不再拆分重组整个地址
+        prefix, _, last = ip.rpartition('.')
+        if prefix.count('.') != 2:
             return [ip]
         try:
-            last_octet = int(parts[3])
+            last_octet = int(last)
         except ValueError:
             return [ip]
 
-        prefix = '.'.join(parts[:3]) + '.'
+        prefix += '.'
         start = max(1, last_octet - CSegmentExpander.EXPAND_WINDOW)
         end = min(254, last_octet + CSegmentExpander.EXPAND_WINDOW)
-        return [f"{prefix}{i}" for i in range(start, end + 1)]
+        return [prefix + OCTET_TEXT[i] for i in range(start, end + 1)]
 
     @staticmethod
     def expand_ipv6_block(ip: str) -> List[str]:
@@ -144,251 +328,516 @@ class AdaptiveSelector:
     3. 动态截断: 只保留前 9 名 (对应 9 个 FCM 域名)
     """
 
-    def __init__(self, timeout: float = TCP_TIMEOUT, max_workers: int = MAX_WORKERS):
+    def __init__(self, timeout: float = TCP_TIMEOUT, max_workers: int = MAX_WORKERS,
+                 cache: Optional['ProbeCache'] = None):
         self.timeout = timeout
         self.max_workers = max_workers
+        self.cache = cache
 
-    def get_c_segment(self, ip: str) -> str:
+    @staticmethod
+    def _block_v4(ip: str) -> str:
         """获取 IPv4 C 段"""
-        parts = ip.split('.')
-        if len(parts) == 4:
-            return '.'.join(parts[:3]) + '.'
+        # 切到最后一个 '.' 为止即为 C 段前缀, 不必拆分再拼接
+        cut = ip.rfind('.') + 1
+        if ip.count('.', 0, cut) == 3:
+            return ip[:cut]
         return ip
 
-    def get_ipv6_block(self, ip: str) -> str:
+    @staticmethod
+    def _block_v6(ip: str) -> str:
         """获取 IPv6 /64 段"""
         parts = ip.split(':')
         if len(parts) >= 4:
             return ':'.join(parts[:4]) + ':'
         return ip
 
-    def expand_and_rescan(self, initial_ips: List[str]) -> List[SpeedResult]:
+    async def expand_and_rescan(self, initial_ips: List[str], family: int) -> SpeedResults:
         """C 段爆破 + 重新扫描 (防扫描策略)"""
+        label = FAMILY_LABELS[family]
+        # 整批同一地址族: 分组和扩展函数在进入循环前选定一次
+        if family == socket.AF_INET6:
+            get_block, expand_block = self._block_v6, CSegmentExpander.expand_ipv6_block
+        else:
+            get_block, expand_block = self._block_v4, CSegmentExpander.expand_c_segment
+
+        cache = self.cache
+        if cache:
+            # 跳过历史上连续失败的 IP (按概率抽样复测)
+            probe_ips = [ip for ip in initial_ips if cache.should_probe(ip)]
+            if len(probe_ips) < len(initial_ips):
+                print(f"  [{label}] Cache: skipping {len(initial_ips) - len(probe_ips)} likely-dead seeds")
+            initial_ips = probe_ips
+
         # 首次扫描 - 先 shuffle 打破顺序
-        print(f"  Initial scan: {len(initial_ips)} IPs...")
+        print(f"  [{label}] Initial scan: {len(initial_ips)} IPs...")
         random.shuffle(initial_ips)  # 防止顺序扫描被识别
-        initial_results = batch_measure(initial_ips, timeout=self.timeout, max_workers=self.max_workers)
-
-        # 找出成功的 IP，按网段分组
-        successful = [r for r in initial_results if r.success]
-        print(f"  First pass: {len(successful)} successful")
-
-        if not successful:
-            return initial_results
-
-        # 按网段分组
-        blocks = {}
-        for r in successful:
-            if ':' in r.ip:  # IPv6
-                block = self.get_ipv6_block(r.ip)
-            else:  # IPv4
-                block = self.get_c_segment(r.ip)
-            if block not in blocks:
-                blocks[block] = []
-            blocks[block].append(r)
-
-        print(f"  Found {len(blocks)} successful blocks, expanding...")
-
-        # 爆破每个成功的网段
-        ips_to_rescan = []
-        for block, success_ips in blocks.items():
-            if ':' in block:  # IPv6
-                seed = success_ips[0].ip
-                expanded = CSegmentExpander.expand_ipv6_block(seed)
-            else:  # IPv4
-                seed = success_ips[0].ip
-                expanded = CSegmentExpander.expand_c_segment(seed)
+        results = await batch_measure(initial_ips, family, timeout=self.timeout, max_workers=self.max_workers)
+        if cache:
+            cache.update(results)
+
+        print(f"  [{label}] First pass: {results.success_count} successful")
+
+        if not results.success_count:
+            return results
+
+        successful = results.successful_ips()
+
+        # 按网段分组: 爆破只需要每个网段的首个成功 IP 作为种子, 无需收集整组
+        seeds: Dict[str, str] = {}
+        for ip in successful:
+            seeds.setdefault(get_block(ip), ip)
+
+        print(f"  [{label}] Found {len(seeds)} successful blocks, expanding...")
+
+        # 爆破每个成功的网段, 记录每个新 IP 所属的网段编号
+        # 已测集合只建一次, 各网段共用 (首轮结果在循环中不会变化)
+        tested = set(results.ips)
+        rescan: List[Tuple[str, int]] = []
+        for group, (block, seed) in enumerate(seeds.items()):
+            expanded = expand_block(seed)
 
             # 过滤掉已经测过的
-            tested = {r.ip for r in initial_results}
             new_ips = [ip for ip in expanded if ip not in tested]
-            ips_to_rescan.extend(new_ips)
-            print(f"    {block}: +{len(new_ips)} new IPs to scan")
+            if cache:
+                new_ips = [ip for ip in new_ips if cache.should_probe(ip)]
+            rescan.extend((ip, group) for ip in new_ips)
+            print(f"    [{label}] {block}: +{len(new_ips)} new IPs to scan")
 
-        if not ips_to_rescan:
-            print("  No new IPs to expand")
-            return initial_results
+        if not rescan:
+            print(f"  [{label}] No new IPs to expand")
+            return results
 
         # 重新扫描新 IPs - 先 shuffle 打破顺序
-        print(f"  Expanding scan: {len(ips_to_rescan)} new IPs...")
-        random.shuffle(ips_to_rescan)  # 防止顺序扫描被识别
-        expanded_results = batch_measure(ips_to_rescan, timeout=self.timeout, max_workers=self.max_workers)
-
-        # 合并结果
-        all_results = initial_results + expanded_results
-        return all_results
-
-    def select_top_ips(self, results: List[SpeedResult]) -> List[str]:
+        print(f"  [{label}] Expanding scan: {len(rescan)} new IPs...")
+        random.shuffle(rescan)  # 防止顺序扫描被识别
+        ips_to_rescan = [ip for ip, _ in rescan]
+        groups = [group for _, group in rescan]
+        # 每个网段凑够 BLOCK_SUCCESS_QUOTA 个成功 IP 即停止, 不为其余地址等满超时
+        new_results = await batch_measure(ips_to_rescan, family, timeout=self.timeout,
+                                          max_workers=self.max_workers,
+                                          groups=groups, quota=BLOCK_SUCCESS_QUOTA)
+        if cache:
+            cache.update(new_results)
+
+        # 合并结果 (列式拼接)
+        return results + new_results
+
+    def select_top_ips(self, results: SpeedResults, family: int) -> List[str]:
         """自适应选优: 按延迟排序，动态截断"""
-        # 只保留成功的
-        successful = [r for r in results if r.success]
+        label = FAMILY_LABELS[family]
+        success_count = results.success_count
 
-        if not successful:
-            print(f"  No successful connections")
+        if not success_count:
+            print(f"  [{label}] No successful connections")
             return []
 
-        # 按延迟从低到高排序
-        sorted_results = sorted(successful, key=lambda x: x.latency_ms)
-
         # 动态截断: 保留前 12 名 (对应 12 个 FCM 域名)
         target_count = len(FCM_DOMAINS) * MIN_IPS_PER_DOMAIN  # 至少 12 个
 
-        if len(sorted_results) > target_count:
-            top_ips = sorted_results[:target_count]
-            dropped = len(sorted_results) - target_count
-            print(f"  Selected top {len(top_ips)} IPs, dropped {dropped} slower IPs")
+        # 过滤成功项与选优在同一趟扫描中完成
+        if success_count > target_count:
+            # 只需最快的 k 个: 堆选择 O(n log k), 无需整体排序
+            top_idx = heapq.nsmallest(target_count, results.successful_indices(),
+                                      key=results.latencies.__getitem__)
+            dropped = success_count - target_count
+            print(f"  [{label}] Selected top {len(top_idx)} IPs, dropped {dropped} slower IPs")
         else:
-            top_ips = sorted_results
-            print(f"  Selected all {len(top_ips)} successful IPs")
+            top_idx = list(results.successful_indices())
+            print(f"  [{label}] Selected all {len(top_idx)} successful IPs")
 
         # 再次 shuffle 避免固定顺序
-        random.shuffle(top_ips)
+        random.shuffle(top_idx)
 
-        return [r.ip for r in top_ips]
+        ips = results.ips
+        return [ips[i] for i in top_idx]
 
 
 class LoadBalancer:
-    """负载均衡器: Shuffle + Round-Robin 分配 IP 到域名"""
+    """负载均衡器: Shuffle + Round-Robin 分配 IP 到域名 (仅在主线程顺序调用, 无需加锁)"""
 
     def __init__(self, ips: List[str], shuffle: bool = True):
         if shuffle:
             random.shuffle(ips)
         self.ips = ips
-        self.index = 0
-        self.lock = Lock()
+        # 轮转计数器: next() 在 CPython 中是单条 C 调用, 无需加锁也不必手动维护下标
+        self.counter = itertools.count()
 
     def assign(self, domain: str) -> str:
         """为域名分配一个 IP (Round-Robin)"""
         if not self.ips:
             return ""
 
-        with self.lock:
-            ip = self.ips[self.index % len(self.ips)]
-            self.index += 1
-            return ip
+        return self.ips[next(self.counter) % len(self.ips)]
+
+    def reset(self):
+        """轮转回到起点 (保留已打乱的顺序, 供下一个 hosts 文件复用)"""
+        self.counter = itertools.count()
 
     def generate_entries(self, domains: List[str]) -> List[Tuple[str, str]]:
-        """生成 hosts 条目"""
-        return [(self.assign(domain), domain) for domain in domains]
+        """生成 hosts 条目 (按轮转下标一次性算出)"""
+        if not self.ips:
+            return [("", domain) for domain in domains]
 
+        ips = self.ips
+        n = len(ips)
+        # domains 放在 zip 的前面: 域名耗尽时不会多消耗一个计数
+        return [(ips[i % n], domain) for domain, i in zip(domains, self.counter)]
 
-def load_ips(filepath: str) -> List[str]:
-    """加载 IP 列表"""
+
+def load_ips(filepath: str, family: int) -> List[str]:
+    """
+    加载 IP 列表
+
+    Args:
+        filepath: 种子 IP 文件 (每个文件只含一种地址族)
+        family: 文件对应的地址族 (AF_INET / AF_INET6)
+
+    Returns:
+        通过校验的 IP 列表
+    """
     try:
         with open(filepath, 'r') as f:
-            return [line.strip() for line in f if line.strip()]
+            ips = [line.strip() for line in f if line.strip()]
     except FileNotFoundError:
         print(f"[WARN] File not found: {filepath}")
         return []
 
+    # 加载时用 inet_pton 校验一次: 非法或地址族不符的行在这里剔除,
+    # 之后 connect 走 CPython 的数字地址快速路径, 热路径上不再出现解析异常
+    valid = []
+    for ip in ips:
+        try:
+            socket.inet_pton(family, ip)
+        except OSError:
+            continue
+        valid.append(ip)
+
+    if len(valid) < len(ips):
+        print(f"[WARN] Dropped {len(ips) - len(valid)} malformed entries from {filepath}")
+    return valid
+
 
-def batch_measure(ips: List[str], port: int = FCM_PORT,
-                  max_workers: int = MAX_WORKERS,
-                  timeout: float = TCP_TIMEOUT) -> List[SpeedResult]:
-    """批量测速"""
+class ProbeCache:
+    """
+    跨运行的测速历史缓存: IP -> [连续失败次数, 最近延迟毫秒, 最近测速时间戳]
+
+    连续失败达到 DEAD_AFTER_FAILURES 次的 IP 视为疑似失效, 之后每次运行只以
+    RECHECK_PROBABILITY 的概率抽样复测, 其余直接跳过, 不再为其等满超时;
+    一旦复测成功, 失败计数清零。
+    """
+
+    def __init__(self, path: str, entries: Dict[str, list]):
+        self.path = path
+        self.entries = entries
+
+    @classmethod
+    def load(cls, path: str) -> 'ProbeCache':
+        """读取缓存文件, 丢弃过期记录; 文件缺失或损坏时从空缓存开始"""
+        try:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Ignoring unreadable cache {path}: {e}")
+            data = {}
+
+        if not isinstance(data, dict):
+            print(f"[WARN] Ignoring malformed cache {path}: top level is not an object")
+            data = {}
+
+        now = time.time()
+        entries = {}
+        malformed = 0
+        for ip, entry in data.items():
+            if not cls._valid_entry(entry):
+                malformed += 1
+            elif now - entry[2] < CACHE_MAX_AGE:
+                entries[ip] = entry
+        if malformed:
+            print(f"[WARN] Dropped {malformed} malformed entries from cache {path}")
+        return cls(path, entries)
+
+    @staticmethod
+    def _valid_entry(entry) -> bool:
+        """记录必须是 [失败次数, 延迟, 时间戳] 三个数值 (bool 不算)"""
+        return (isinstance(entry, list) and len(entry) == 3
+                and all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in entry))
+
+    def should_probe(self, ip: str) -> bool:
+        """该 IP 本次是否需要测速"""
+        entry = self.entries.get(ip)
+        if entry is None or entry[0] < DEAD_AFTER_FAILURES:
+            return True
+        return random.random() < RECHECK_PROBABILITY
+
+    def update(self, results: SpeedResults):
+        """把一批测速结果计入历史 (只有确定失败才累计, 跳过与自适应截断不计)"""
+        # 整批零成功多半是 runner 自身断网, 此时不累计失败次数, 以免把健康 IP 误判为失效
+        record_failures = results.success_count > 0
+        entries = self.entries
+        now = int(time.time())
+        for ip, latency in zip(results.ips, results.latencies):
+            if latency >= 0:
+                entries[ip] = [0, round(latency, 1), now]
+            elif latency == PROBE_FAILED and record_failures:
+                entry = entries.get(ip)
+                entries[ip] = [(entry[0] if entry else 0) + 1, PROBE_FAILED, now]
+
+    def save(self):
+        """整个缓存序列化后一次写入"""
+        data = json.dumps(self.entries, separators=(',', ':')).encode('ascii')
+        write_file(self.path, data)
+
+
+async def _measure_all(speedometer: TCPSpeedometer, family: int,
+                       targets: List[tuple], max_workers: int,
+                       groups: Optional[List[int]] = None,
+                       quota: int = 0) -> Tuple[array, int]:
+    """
+    在同一个事件循环中并发测速, 结果按下标写入延迟数组
+
+    始终保持最多 max_workers 个 connect 在途, 每完成一个就补发下一个。
+    给出 groups (每个目标所属网段编号) 时启用提前终止: 某个网段成功数达到 quota 后,
+    该网段仍在途的 connect 立即取消, 尚未发起的直接跳过, 不再等待超时。
+
+    Returns:
+        (延迟数组, 因提前终止而跳过的目标数); 跳过的目标延迟记为 PROBE_SKIPPED
+    """
+    loop = asyncio.get_running_loop()
+    total = len(targets)
+    latencies = array('d', [PROBE_FAILED]) * total
+    finished = loop.create_future()
+    next_index = 0
+    remaining = total
+    skipped = 0
+
+    if groups is not None:
+        group_count = max(groups) + 1
+        hits = [0] * group_count                                          # 网段 -> 已成功数
+        inflight: List[Dict[int, Callable]] = [{} for _ in range(group_count)]  # 网段 -> {下标: 取消函数}
+
+    def launch():
+        nonlocal next_index, remaining, skipped
+        while next_index < total:
+            index = next_index
+            next_index += 1
+            if groups is not None and hits[groups[index]] >= quota:
+                latencies[index] = PROBE_SKIPPED
+                remaining -= 1
+                skipped += 1
+                continue
+            cancel = speedometer.probe(loop, family, targets[index],
+                                       lambda latency: on_done(index, latency))
+            if groups is not None and cancel is not None:
+                inflight[groups[index]][index] = cancel
+            return
+
+        if remaining == 0 and not finished.done():
+            finished.set_result(None)
+
+    def on_done(index: int, latency: float):
+        nonlocal remaining, skipped
+        latencies[index] = latency
+        remaining -= 1
+        freed = 1
+
+        if groups is not None:
+            group = groups[index]
+            running = inflight[group]
+            running.pop(index, None)
+            if latency >= 0:
+                hits[group] += 1
+                if hits[group] >= quota and running:
+                    # 网段已凑够, 取消其余在途探测并把空出的并发额度让给其他网段
+                    for cancelled, cancel in running.items():
+                        cancel()
+                        latencies[cancelled] = PROBE_SKIPPED
+                    freed += len(running)
+                    remaining -= len(running)
+                    skipped += len(running)
+                    running.clear()
+
+        for _ in range(freed):
+            launch()
+
+    for _ in range(min(max_workers, total)):
+        launch()
+
+    await finished
+    return latencies, skipped
+
+
+async def batch_measure(ips: List[str], family: int, port: int = FCM_PORT,
+                        max_workers: int = MAX_WORKERS,
+                        timeout: float = TCP_TIMEOUT,
+                        groups: Optional[List[int]] = None,
+                        quota: int = 0) -> SpeedResults:
+    """
+    批量测速, 返回列式存储的测速结果
+
+    Args:
+        groups: 可选, 与 ips 平行的网段编号 (0 起连续整数), 用于按网段提前终止
+        quota: 每个网段凑够多少个成功 IP 后停止该网段的剩余探测
+    """
     if not ips:
-        return []
+        return SpeedResults.empty()
+
+    ips = list(ips)
+    # 整批构造 sockaddr
+    targets = make_sockaddrs(ips, family, port)
 
     speedometer = TCPSpeedometer(port, timeout)
-    results = []
 
-    print(f"  Measuring {len(ips)} IPs with {max_workers} threads...")
+    label = FAMILY_LABELS[family]
+    print(f"  [{label}] Measuring {len(ips)} IPs with {max_workers} concurrent connects...")
+
+    latencies, skipped = await _measure_all(speedometer, family, targets,
+                                            max_workers, groups, quota)
+
+    success_count = speedometer.success_count
+    failed = len(ips) - success_count - skipped
+    if skipped:
+        print(f"  [{label}] Success: {success_count}, Failed: {failed}, Skipped: {skipped} (block quota reached)")
+    else:
+        print(f"  [{label}] Success: {success_count}, Failed: {failed}")
+    if speedometer.current_timeout < timeout:
+        print(f"  [{label}] Adaptive timeout: {speedometer.current_timeout:.2f}s (base {timeout}s)")
+
+    return SpeedResults(ips, latencies, success_count)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(speedometer.measure, ip): ip for ip in ips}
 
-        for i, future in enumerate(concurrent.futures.as_completed(futures)):
-            result = future.result()
-            results.append(result)
+# 输出文件打开方式: 截断重写
+OUTPUT_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
 
-    success_count = sum(1 for r in results if r.success)
-    print(f"  Success: {success_count}, Failed: {len(results) - success_count}")
+# hosts 文件头模板: 只有日期和类型随调用变化, 其余部分在模块加载时固定
+HOSTS_HEADER_TEMPLATE = (
+    "# Generated by Project Mjolnir\n"
+    "# Date: {date}\n"
+    "# Type: {ip_type}\n"
+    "#\n"
+    "# FCM Domains: " + ", ".join(FCM_DOMAINS[:3]) + "...\n"
+    "# Generated using Adaptive Ranking with C-Segment Expansion\n"
+    "#\n"
+    "\n"
+)
 
-    return results
 
+def write_file(path: str, data: bytes):
+    """截断重写文件, 整块数据一次 os.write 落盘"""
+    fd = os.open(path, OUTPUT_OPEN_FLAGS, 0o644)
+    try:
+        view = memoryview(data)
+        while view:  # 普通文件一次即可写完, 循环只为防御短写
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def write_hosts(path: str, entries: List[Tuple[str, str]], ip_type: str):
+    """
+    生成 hosts 文件并一次性写入 (去重)
 
-def generate_hosts_content(entries: List[Tuple[str, str]], ip_type: str) -> str:
-    """生成 hosts 文件内容 (去重)"""
-    lines = [
-        f"# Generated by Project Mjolnir",
-        f"# Date: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')}",
-        f"# Type: {ip_type}",
-        f"#",
-        f"# FCM Domains: {', '.join(FCM_DOMAINS[:3])}...",
-        f"# Generated using Adaptive Ranking with C-Segment Expansion",
-        f"#",
-        "",
-    ]
+    Args:
+        path: 输出文件路径
+        entries: (IP, 域名) 条目列表
+        ip_type: 写入文件头的类型描述
+    """
+    header = HOSTS_HEADER_TEMPLATE.format(
+        date=datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z'),
+        ip_type=ip_type,
+    )
 
+    # 整个文件先拼进一块 bytearray, 再一次写入
+    buf = bytearray(header.encode('ascii'))
     seen = set()
-    for ip, domain in entries:
-        if ip and (ip, domain) not in seen:
-            seen.add((ip, domain))
-            lines.append(f"{ip} {domain}")
+    seen_add = seen.add
+    sep = b""  # 条目之间换行, 末尾不留空行
+    for entry in entries:
+        ip, domain = entry
+        if ip and entry not in seen:
+            seen_add(entry)
+            buf += sep
+            buf += ip.encode('ascii')
+            buf += b" "
+            buf += domain.encode('ascii')
+            sep = b"\n"
+
+    write_file(path, buf)
+
+
+async def run_pipeline(selector: AdaptiveSelector, ips: List[str], family: int) -> List[str]:
+    """
+    单个地址族的完整流程: 网段爆破扫描 -> 自适应选优
 
-    return "\n".join(lines)
+    Args:
+        selector: 共享的选优器
+        ips: 已加载的种子 IP
+        family: 种子 IP 的地址族
+
+    Returns:
+        选出的优质 IP 列表
+    """
+    label = FAMILY_LABELS[family]
+    print(f"  [{label}] Loaded {len(ips)} seed IPs")
+
+    if not ips:
+        print(f"  [{label}] No {label} IPs to process")
+        return []
+
+    # 网段爆破 (IPv4 C 段 / IPv6 /124) + 重新扫描
+    results = await selector.expand_and_rescan(ips, family)
+    # 自适应选优: 只保留前 12 名
+    return selector.select_top_ips(results, family)
 
 
-def main():
+async def main():
     """主入口"""
     print("=" * 60)
     print("FCM Sommelier - Project Mjolnir 2.0")
     print("=" * 60)
 
-    selector = AdaptiveSelector(timeout=TCP_TIMEOUT, max_workers=MAX_WORKERS)
-    all_results = {}
+    cache = ProbeCache.load(IP_CACHE_FILE)
 
-    # ===== IPv4 处理 =====
-    print("\n[Step 1] C-Segment Expansion + Adaptive Ranking (IPv4)...")
-    ipv4_ips = load_ips("raw_ips_v4.txt")
-    random.shuffle(ipv4_ips)
-    print(f"  Loaded {len(ipv4_ips)} seed IPs")
+    # ===== IPv4 / IPv6 并行处理 =====
+    # 两个地址族互不共享状态, 在同一个事件循环中并发扫描, 总耗时取决于较慢的一侧
+    print("\n[Step 1] Block Expansion + Adaptive Ranking (IPv4 + IPv6 in parallel)...")
+    ipv4_ips = load_ips("raw_ips_v4.txt", socket.AF_INET)
+    ipv6_ips = load_ips("raw_ips_v6.txt", socket.AF_INET6)
 
-    if ipv4_ips:
-        # C 段爆破 + 重新扫描
-        ipv4_all_results = selector.expand_and_rescan(ipv4_ips)
-        # 自适应选优: 只保留前 9 名
-        all_results['v4'] = selector.select_top_ips(ipv4_all_results)
-    else:
-        all_results['v4'] = []
-        print("  No IPv4 IPs to process")
-
-    # ===== IPv6 处理 =====
-    print("\n[Step 2] IPv6 Block Expansion + Adaptive Ranking (IPv6)...")
-    ipv6_ips = load_ips("raw_ips_v6.txt")
-    random.shuffle(ipv6_ips)
-    print(f"  Loaded {len(ipv6_ips)} seed IPs")
-
-    if ipv6_ips:
-        # IPv6 /124 爆破 + 重新扫描
-        ipv6_all_results = selector.expand_and_rescan(ipv6_ips)
-        # 自适应选优: 只保留前 9 名
-        all_results['v6'] = selector.select_top_ips(ipv6_all_results)
-    else:
-        all_results['v6'] = []
-        print("  No IPv6 IPs to process")
+    # fd 额度只在实际有种子 IP 的流水线之间平分
+    active = sum(1 for ips in (ipv4_ips, ipv6_ips) if ips)
+    workers = clamp_to_fd_limit(MAX_WORKERS, share=max(1, active))
+    selector = AdaptiveSelector(timeout=TCP_TIMEOUT, max_workers=workers, cache=cache)
+
+    top_v4, top_v6 = await asyncio.gather(
+        run_pipeline(selector, ipv4_ips, socket.AF_INET),
+        run_pipeline(selector, ipv6_ips, socket.AF_INET6),
+    )
+    all_results = {'v4': top_v4, 'v6': top_v6}
+
+    # 测速历史落盘, 供下次运行跳过疑似失效的 IP
+    cache.save()
 
     # ===== 生成 hosts 文件 =====
-    print("\n[Step 3] Generating hosts files...")
+    print("\n[Step 2] Generating hosts files...")
+
+    # 每个地址族只构造 (并打乱) 一次, 单栈与双栈文件共用
+    lb_v4 = LoadBalancer(all_results['v4']) if all_results['v4'] else None
+    lb_v6 = LoadBalancer(all_results['v6']) if all_results['v6'] else None
 
     # 生成 IPv4 only
-    if all_results['v4']:
-        lb_v4 = LoadBalancer(all_results['v4'])
+    if lb_v4:
         entries_v4 = lb_v4.generate_entries(FCM_DOMAINS)
-        content_v4 = generate_hosts_content(entries_v4, "IPv4 Only")
-        with open("fcm_ipv4.hosts", 'w') as f:
-            f.write(content_v4)
+        write_hosts("fcm_ipv4.hosts", entries_v4, "IPv4 Only")
         print(f"  Generated fcm_ipv4.hosts ({len(entries_v4)} entries)")
     else:
         print("  Skipping fcm_ipv4.hosts (no premium IPv4 IPs)")
 
     # 生成 IPv6 only
-    if all_results['v6']:
-        lb_v6 = LoadBalancer(all_results['v6'])
+    if lb_v6:
         entries_v6 = lb_v6.generate_entries(FCM_DOMAINS)
-        content_v6 = generate_hosts_content(entries_v6, "IPv6 Only")
-        with open("fcm_ipv6.hosts", 'w') as f:
-            f.write(content_v6)
+        write_hosts("fcm_ipv6.hosts", entries_v6, "IPv6 Only")
         print(f"  Generated fcm_ipv6.hosts ({len(entries_v6)} entries)")
     else:
         print("  Skipping fcm_ipv6.hosts (no premium IPv6 IPs)")
@@ -396,21 +845,22 @@ def main():
     # 生成 Dual-stack (1:1 分配: 每个域名分配 1 个 v4 + 1 个 v6)
     entries_dual = []
 
-    if all_results['v4'] and all_results['v6']:
+    # 复用单栈文件的负载均衡器, 从轮转起点重新分配
+    for lb in (lb_v4, lb_v6):
+        if lb:
+            lb.reset()
+
+    if lb_v4 and lb_v6:
         # 双栈: 每个域名分配 v4 和 v6
-        lb_v4 = LoadBalancer(all_results['v4'], shuffle=True)
-        lb_v6 = LoadBalancer(all_results['v6'], shuffle=True)
         for domain in FCM_DOMAINS:
             entries_dual.append((lb_v4.assign(domain), domain))
             entries_dual.append((lb_v6.assign(domain), domain))
-    elif all_results['v4']:
+    elif lb_v4:
         # 只有 v4: 每个域名分配 1 个 v4
-        lb_v4 = LoadBalancer(all_results['v4'], shuffle=True)
         for domain in FCM_DOMAINS:
             entries_dual.append((lb_v4.assign(domain), domain))
-    elif all_results['v6']:
+    elif lb_v6:
         # 只有 v6: 每个域名分配 1 个 v6
-        lb_v6 = LoadBalancer(all_results['v6'], shuffle=True)
         for domain in FCM_DOMAINS:
             entries_dual.append((lb_v6.assign(domain), domain))
 
@@ -423,9 +873,7 @@ def main():
         else:
             desc = "Dual Stack (IPv4 Only)"
 
-        content_dual = generate_hosts_content(entries_dual, desc)
-        with open("fcm_dual.hosts", 'w') as f:
-            f.write(content_dual)
+        write_hosts("fcm_dual.hosts", entries_dual, desc)
         print(f"  Generated fcm_dual.hosts ({len(entries_dual)} entries) [{desc}]")
     else:
         print("  Skipping fcm_dual.hosts (no IPs available)")
@@ -438,4 +886,6 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(main())